@@ -1,18 +1,72 @@
 from typing import List, Dict, Optional
 import asyncio
 import os
+import time
+
+import diskcache
+import orjson
 
 import notion_api
 import llm_api
 
+# Remembers the last_edited_time each page had when it was processed, so
+# unchanged pages can skip the expensive block crawl across polling cycles
+_page_cache = diskcache.Cache('./.notion_cache')
+
+# Hot-path lookups for parse_block: O(1) set membership instead of
+# prefix scans/list comparisons, and a shared empty dict fallback
+_EMPTY = {}
+_HEADING_TYPES = frozenset({'heading_1', 'heading_2', 'heading_3'})
+_MULTILINE_TYPES = frozenset({'paragraph', 'quote', 'code'})
+
+def _parse_code(content_data: Dict, append_piece) -> None:
+    """Append a fenced code block"""
+    code_text = content_data.get('text', [])
+    if code_text:
+        append_piece("```" + content_data.get('language', '') + "\n")
+        for rt in code_text:
+            plain_text = rt.get('plain_text')
+            if plain_text:
+                append_piece(plain_text)
+        append_piece("\n```")
+
+def _parse_rich_text(content_data: Dict, append_piece) -> None:
+    """Append rich text spans with basic markdown formatting; markers are
+    appended as tokens instead of allocating wrapped strings"""
+    for rt in content_data.get('rich_text', []):
+        plain_text = rt.get('plain_text')
+        if plain_text:
+            ann = rt.get('annotations') or _EMPTY
+            bold = ann.get('bold')
+            italic = ann.get('italic')
+            prefix = ('*' if italic else '') + ('**' if bold else '')
+            suffix = ('**' if bold else '') + ('*' if italic else '')
+            if prefix:
+                append_piece(prefix, plain_text, suffix)
+            else:
+                append_piece(plain_text)
+
+# Per-type content handlers: parse_block does a single dict lookup instead
+# of an if/elif chain; types without an entry are unsupported
+_PARSERS = {
+    'paragraph': _parse_rich_text,
+    'heading_1': _parse_rich_text,
+    'heading_2': _parse_rich_text,
+    'heading_3': _parse_rich_text,
+    'bulleted_list_item': _parse_rich_text,
+    'numbered_list_item': _parse_rich_text,
+    'quote': _parse_rich_text,
+    'code': _parse_code,
+    'callout': _parse_rich_text,
+    'toggle': _parse_rich_text,
+}
+
 class DocuMate:
-    
-    SUPPORTED_BLOCK_TYPES = {
-        'paragraph', 'heading_1', 'heading_2', 'heading_3',
-        'bulleted_list_item', 'numbered_list_item', 'quote',
-        'code', 'callout', 'toggle'
-    }
-        
+
+    SUPPORTED_BLOCK_TYPES = frozenset(_PARSERS)
+
+    CURSOR_FILE = '.documate_cursor'
+
     def __init__(self, _via_factory=False):
         if not _via_factory:
             raise RuntimeError("Must use factory method create() for initialization")
@@ -20,7 +74,18 @@ class DocuMate:
         self.processed_flag = "Processed"
         self.tag_property = "Tag"
         self.summary_property = "Summary"
-        self.current_tags = set() 
+        self.current_tags = set()
+        self._tags_fetched_at = 0.0
+        # The first (cursor-less) page of the unprocessed query never
+        # changes, so serialize it once instead of on every poll
+        self._unprocessed_payload = orjson.dumps({
+            "page_size": 100,
+            "filter": {
+                "property": self.processed_flag,
+                "checkbox": {"equals": False}
+            },
+            "sorts": [{"property": "Created", "direction": "descending"}]
+        })
         self.language = os.getenv("DEFAULT_LANGUAGE", "zh-CN")
         print(f"language: {self.language}")
 
@@ -38,104 +103,149 @@ class DocuMate:
         tags = {tag.get('name') for tag in tags}
 
         self.current_tags = tags
+        self._tags_fetched_at = time.monotonic()
 
         return tags
-    
+
+    async def refresh_tags_if_stale(self, ttl: int = 3600):
+        """
+        Re-pull tag options from Notion only when the local view is older
+        than ttl seconds. update_page already merges newly created tags
+        into current_tags, so the full schema download is rarely needed.
+        """
+        if time.monotonic() - self._tags_fetched_at >= ttl:
+            await self.get_tag_info()
+
+    async def iter_unprocessed_batches(self):
+        """
+        Yield batches of unprocessed pages (one query result page each),
+        following the query cursor.
+        """
+        next_cursor = None
+        while True:
+            try:
+                if next_cursor is None:
+                    results = await notion_api.query_database(
+                        raw_body=self._unprocessed_payload
+                    )
+                else:
+                    results = await notion_api.query_database(
+                        filter={
+                            "property": self.processed_flag,
+                            "checkbox": {"equals": False}
+                        },
+                        sorts=[{"property": "Created", "direction": "descending"}],
+                        start_cursor=next_cursor
+                    )
+            except notion_api.NotionAPIError as e:
+                print(f"Error fetching unprocessed pages: {str(e)}")
+                return
+            except Exception as e:
+                print(f"Unexpected error in iter_unprocessed_batches: {str(e)}")
+                return
+
+            yield results.get('results', [])
+
+            if not results.get('has_more'):
+                return
+            next_cursor = results.get('next_cursor')
+
+    async def iter_unprocessed_pages(self):
+        """
+        Yield unprocessed pages lazily. Memory stays O(page_size)
+        regardless of how large the backlog is, and callers can start
+        working before later pages are fetched.
+        """
+        async for batch in self.iter_unprocessed_batches():
+            for page in batch:
+                yield page
+
     async def get_unprocessed_pages(self) -> List[Dict]:
         """
-        Retrieve all unprocessed block objects (max 100)
+        Retrieve all unprocessed block objects
         Returns:
             List[Dict]: List of dictionaries containing unprocessed block info
         """
-        try:
-            results = await notion_api.query_database(
-                filter={
-                    "property": self.processed_flag,
-                    "checkbox": {"equals": False}
-                },
-                sorts=[{"property": "Created", "direction": "descending"}]
-            )
-            return results.get('results', [])
-        except notion_api.NotionAPIError as e:
-            print(f"Error fetching unprocessed pages: {str(e)}")
-            return []
-        except Exception as e:
-            print(f"Unexpected error in get_unprocessed_pages: {str(e)}")
-            return []
+        return [page async for page in self.iter_unprocessed_pages()]
     
     async def get_block_text_content(self, block_id: str) -> str:
         """Asynchronously retrieve block content"""
-        async def parse_block(block: Dict) -> str:
-            """Parse individual block content"""
-            if block.get('type') not in self.SUPPORTED_BLOCK_TYPES:
-                return f"\n[Unsupported block type: {block.get('type')}]\n"
-            
-            content = []
+        async def parse_block(block: Dict, out: List[str]) -> None:
+            """Parse individual block content, appending tokens into `out`"""
             block_type = block.get('type')
-            
-            # Get content through different possible paths
-            content_data = block.get(block_type, {})
-            rich_texts = content_data.get('rich_text', [])
-            
-            # Handle special types
-            if block_type == 'code':
-                code_text = content_data.get('text', [])
-                if code_text:
-                    content.append("```" + content_data.get('language', '') + "\n")
-                    content.extend(rt['plain_text'] for rt in code_text if rt.get('plain_text'))
-                    content.append("\n```")
-            else:
-                # Extract regular rich text content
-                for rt in rich_texts:
-                    if rt.get('plain_text'):
-                        text = rt['plain_text']
-                        # Apply basic formatting
-                        if rt.get('annotations', {}).get('bold'):
-                            text = f'**{text}**'
-                        if rt.get('annotations', {}).get('italic'):
-                            text = f'*{text}*'
-                        content.append(text)
-
-            # Recursively process child blocks
-            if block.get('has_children'):
-                try:
-                    children = await notion_api.async_get_block_children(block['id'], recursive=True)
-                    for child in children.get('results', []):
-                        child_content = await parse_block(child)
-                        content.append(child_content)
-                except Exception as e:
-                    print(f"Error parsing child blocks: {str(e)}")
+            handler = _PARSERS.get(block_type)
+            if handler is None:
+                out.append(f"\n[Unsupported block type: {block_type}]\n")
+                return
 
-            # Add line breaks based on block type
-            if block_type in ['paragraph', 'quote', 'code']:
-                return '\n'.join(content)
-            elif block_type.startswith('heading'):
-                return '\n' + '\n'.join(content) + '\n'
+            # Separator between pieces of this block
+            if block_type in _MULTILINE_TYPES:
+                sep = '\n'
+            elif block_type in _HEADING_TYPES:
+                sep = '\n'
+                out.append('\n')
             else:
-                return ' '.join(content)
-        
-        block_data = await notion_api.async_get_block_children(block_id, recursive=True)
-        if not block_data.get('results'):
+                sep = ' '
+
+            needs_sep = False
+            def append_piece(*tokens: str):
+                nonlocal needs_sep
+                if needs_sep:
+                    out.append(sep)
+                out.extend(tokens)
+                needs_sep = True
+
+            # Extract this block's own content via its type handler
+            handler(block.get(block_type, _EMPTY), append_piece)
+
+            # Recursively process child blocks (siblings in parallel);
+            # children were already embedded by the recursive fetch,
+            # so no extra HTTP requests are issued here
+            children = block.get('children', [])
+            if children:
+                child_bufs: List[List[str]] = [[] for _ in children]
+                results = await asyncio.gather(
+                    *(parse_block(c, buf) for c, buf in zip(children, child_bufs)),
+                    return_exceptions=True
+                )
+                for result, buf in zip(results, child_bufs):
+                    if isinstance(result, Exception):
+                        print(f"Error parsing child blocks: {str(result)}")
+                    else:
+                        append_piece(*buf)
+
+            if block_type in _HEADING_TYPES:
+                out.append('\n')
+
+        async def parse_top_block(block: Dict) -> str:
+            buf: List[str] = []
+            await parse_block(block, buf)
+            return ''.join(buf)
+
+        # Stream blocks as pagination progresses: parsing of earlier blocks
+        # starts while later pages are still being fetched
+        tasks = []
+        async for b in notion_api.iter_block_children(block_id, get_all=True, recursive=True):
+            tasks.append(asyncio.create_task(parse_top_block(b)))
+        if not tasks:
             return ""
-        
-        # Parse all content
-        full_content = []
-        for b in block_data['results']:
-            block_content = await parse_block(b)
-            full_content.append(block_content)
-            
+
+        full_content = await asyncio.gather(*tasks, return_exceptions=True)
+        full_content = [c for c in full_content if not isinstance(c, Exception)]
+
+
         # Modify content concatenation
         return '\n'.join(
             [c for c in full_content if c.strip()]
         ).strip()
 
-    async def generate_summary(self, content: str, language: Optional[str] = None, max_content_length: int = 8192) -> str:
+    async def generate_summary(self, content: str, language: Optional[str] = None, max_content_length: int = 3000) -> str:
         """
         Generate page summary
         Args:
             content (str): Content to summarize
             language (str): Target language for summary
-            max_content_length (int): Maximum content length to process
+            max_content_length (int): Maximum content length to process, in tokens
         Returns:
             str: Generated summary content
         """
@@ -149,15 +259,15 @@ class DocuMate:
         except llm_api.OpenAIAPIError as e:
             raise RuntimeError(f"Summary generation failed: {str(e)}") from e
 
-    async def generate_tags(self, content: str, max_tags: int = 5, 
-                            language: Optional[str] = None, max_content_length: int = 8192) -> List[str]:
+    async def generate_tags(self, content: str, max_tags: int = 5,
+                            language: Optional[str] = None, max_content_length: int = 3000) -> List[str]:
         """
         Generate page tags
         Args:
             content (str): Content to generate tags
             max_tags (int): Maximum number of tags to generate
             language (str): Target language for tags
-            max_content_length (int): Maximum content length to process
+            max_content_length (int): Maximum content length to process, in tokens
         Returns:
             List[str]: Generated tag list
         """
@@ -173,6 +283,30 @@ class DocuMate:
         except llm_api.OpenAIAPIError as e:
             raise RuntimeError(f"Tag generation failed: {str(e)}") from e
 
+    async def summarize_and_tag(self, content: str, max_tags: int = 5,
+                                language: Optional[str] = None, max_content_length: int = 3000):
+        """
+        Generate page summary and tags in one LLM call
+        Args:
+            content (str): Content to process
+            max_tags (int): Maximum number of tags to generate
+            language (str): Target language for summary and tags
+            max_content_length (int): Maximum content length to process, in tokens
+        Returns:
+            Tuple[str, List[str]]: Generated summary and tag list
+        """
+        language = language or self.language
+        try:
+            return await llm_api.summarize_and_tag(
+                content,
+                max_tags=max_tags,
+                language=language,
+                max_content_length=max_content_length,
+                existing_tags=self.current_tags
+            )
+        except llm_api.OpenAIAPIError as e:
+            raise RuntimeError(f"Summary/tag generation failed: {str(e)}") from e
+
     async def update_page(self, page_id: str):
         """
         Update a page with generated summary and tags
@@ -180,15 +314,21 @@ class DocuMate:
             page_id (str): Notion page ID
         """
         try:
+            page = await notion_api.get_page(page_id)
+            last_edited = page.get('last_edited_time')
+            if last_edited and _page_cache.get(page_id) == last_edited:
+                print(f"Skipping unchanged page {page_id}")
+                await notion_api.update_page(page_id, {"Processed": {"checkbox": True}})
+                return
+
             content = await self.get_block_text_content(page_id)
             if content.strip() == "":
                 print(f"Skipping empty content for page {page_id}")
                 await notion_api.update_page(page_id, {"Processed": {"checkbox": True}})
                 return
             
-            summary = await self.generate_summary(content)
-            tags = await self.generate_tags(content)
-            
+            summary, tags = await self.summarize_and_tag(content)
+
             print(f'page_id: {page_id}')
             print(f'summary: {summary}')
             print(f'tags: {tags}')
@@ -210,7 +350,9 @@ class DocuMate:
             
             # if successfully updated, update the current tags
             self.current_tags.update(set(tags))
-            
+            if last_edited:
+                _page_cache.set(page_id, last_edited)
+
         except notion_api.NotionAPIError as e:
             print(f"Notion update failed for page {page_id}: {str(e)}")
             # Mark as processed to avoid infinite retry
@@ -220,17 +362,47 @@ class DocuMate:
         except Exception as e:
             print(f"Unexpected error updating page {page_id}: {str(e)}")
 
-    async def process_unprocessed_pages(self):
-        """Process all unprocessed pages"""
-        try:
-            unprocessed = await self.get_unprocessed_pages()
-            print(f"Found {len(unprocessed)} unprocessed blocks")
-            for page in unprocessed:
+    async def process_unprocessed_pages(self, max_concurrency: int = 8):
+        """Process all unprocessed pages, several at a time"""
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def process_one(page: Dict):
+            async with sem:
                 try:
                     await self.update_page(page['id'])
                     print(f"Processed page {page['id']}")
+                    # Record progress so a crash mid-backlog is visible
+                    with open(self.CURSOR_FILE, 'w') as f:
+                        f.write(page['id'])
                 except Exception as e:
                     print(f"Failed to process page {page['id']}: {str(e)}")
+
+        # maxsize=2 gives single-batch lookahead: the query for batch N+1
+        # runs while the workers are still chewing on batch N, hiding the
+        # query-database round trip entirely
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+
+        async def produce():
+            async for batch in self.iter_unprocessed_batches():
+                await queue.put(batch)
+            await queue.put(None)
+
+        try:
+            producer = asyncio.create_task(produce())
+            total = 0
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    break
+                total += len(batch)
+                # Pages progress in parallel; Notion traffic stays bounded
+                # by the rate limiter in notion_api
+                await asyncio.gather(
+                    *(process_one(page) for page in batch),
+                    return_exceptions=True
+                )
+            await producer
+            print(f"Processed {total} unprocessed blocks")
         except Exception as e:
             print(f"Error in process_unprocessed_pages: {str(e)}")
     
@@ -241,6 +413,9 @@ class DocuMate:
         """
         while True:
             try:
+                # Each polling cycle starts from a fresh view of the workspace
+                notion_api.clear_block_cache()
+                await self.refresh_tags_if_stale()
                 await self.process_unprocessed_pages()
             except Exception as e:
                 print(f"Critical error in main loop: {str(e)}")
@@ -277,8 +452,14 @@ def test_apis():
     asyncio.run(process_first_page())
 
 async def main():
-    dm = await DocuMate.create()
-    await dm.main()
+    await notion_api.startup()
+    await llm_api.startup()
+    try:
+        dm = await DocuMate.create()
+        await dm.main()
+    finally:
+        await llm_api.shutdown()
+        await notion_api.shutdown()
 
 if __name__ == '__main__':
     asyncio.run(main())
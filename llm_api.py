@@ -1,10 +1,17 @@
+import asyncio
+import hashlib
+import json
 import os
+import diskcache
 import dotenv
-from typing import List
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from typing import List, Tuple
+import httpx
+import tiktoken
 from openai import AsyncOpenAI, APIError
 from openai.types.chat import ChatCompletion
 
+import semantic_cache
+
 dotenv.load_dotenv()
 
 # Environment variables configuration
@@ -15,74 +22,340 @@ PERSONAL_DESCRIPTION = os.getenv("PERSONAL_DESCRIPTION", "Someone insteated in A
 
 print(f"personal description: {PERSONAL_DESCRIPTION}")
 
-# Initialize async client
-aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+# Initialize async client with an explicit httpx client: the SDK default
+# caps at 100 connections / 20 keep-alive, which queues sockets under a
+# large fan-out. LLM requests may legitimately wait, so connect/pool
+# timeouts are unset; HTTP/2 multiplexes the streams over one connection.
+def _make_client() -> AsyncOpenAI:
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        base_url=OPENAI_BASE_URL,
+        # SDK-level retries are HTTP-aware: they honor Retry-After and
+        # only retry 408/409/429/5xx, never permanent 4xx errors
+        max_retries=3,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+            timeout=httpx.Timeout(connect=None, pool=None, read=120.0, write=30.0)
+        )
+    )
 
-class OpenAIAPIError(Exception):
-    """Custom API exception"""
-    pass
+aclient = _make_client()
+
+# Lifecycle hooks: bind to the host framework's startup/shutdown (e.g. a
+# FastAPI lifespan) so the client is closed properly instead of being
+# GC'd with open sockets
+async def startup():
+    """Recreate the shared clients if they were closed; safe to call twice"""
+    global aclient
+    if aclient.is_closed():
+        aclient = _make_client()
+    await semantic_cache.startup()
+
+async def shutdown():
+    """Close the shared OpenAI and embedding clients before process exit"""
+    await aclient.close()
+    await semantic_cache.aclose()
+
+# Persistent response cache: reprocessing an unchanged page must not pay
+# for the same tokens twice. Keyed by a hash of the exact request.
+_llm_cache = diskcache.Cache('./.llm_cache')
+_LLM_CACHE_TTL = 7 * 86400
+
+# Tokenizer-aware truncation: character slicing sends up to ~8k tokens of
+# CJK content yet under-fills the budget for English. Trimming on token
+# boundaries sends exactly the intended amount and never splits a
+# multi-byte token
+try:
+    _enc = tiktoken.encoding_for_model(DEFAULT_MODEL)
+except KeyError:
+    _enc = tiktoken.get_encoding("o200k_base")
+
+def _truncate(text: str, max_tokens: int) -> str:
+    tokens = _enc.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return _enc.decode(tokens[:max_tokens])
 
-# Retry decorator
-llm_retry = retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=2, max=10),
-    retry=retry_if_exception_type(APIError),
-    reraise=True
+def _cache_key(prompt: str, temperature: float, max_tokens: int) -> str:
+    raw = f"{DEFAULT_MODEL}|{temperature}|{max_tokens}|{prompt}"
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+def _messages_key(messages: List[dict], temperature: float, max_tokens: int) -> str:
+    return _cache_key("\n".join(m["content"] for m in messages), temperature, max_tokens)
+
+# Prompt layout for provider-side prefix caching: static instructions go
+# first (system), the changing document goes last (user), so the prefix
+# matches across calls and providers can reuse the cached prefix
+SUMMARIZE_SYS_PROMPT = (
+    "Please summarize the content provided by the user in one sentence, "
+    "retaining key information, in [language={language}]."
 )
 
-@llm_retry
-async def chat_completion(**kwargs) -> ChatCompletion:
-    """Unified chat completion interface"""
-    try:
-        return await aclient.chat.completions.create(**kwargs)
-    except APIError as e:
-        raise OpenAIAPIError(f"API request failed: {str(e)}") from e
+TAGS_SYS_PROMPT = (
+    "Please generate [at most] {max_tags} highly specific and meaningful tags "
+    "for archiving and categorizing the article provided by the user. Focus on "
+    "key technical concepts, domains, and methodologies that would help with "
+    "content organization and retrieval. Avoid generic or overly broad tags. "
+    "Generate from the perspective of the user (comma-separated, lowercase, "
+    "no spaces, in [language={language}]).\n\n"
+    "Example format: tag1,tag2,tag3"
+)
 
-async def summarize_text(text: str, language: str = "zh-CN", max_content_length: int = 8192) -> str:
-    """Summarize text content with AI"""
-    prompt = f"""Please summarize the following content in one sentence, retaining key information in [{language=}]:
-    
-    {text[:max_content_length]}"""
-    
+SUMMARIZE_AND_TAG_SYS_PROMPT = (
+    "Please process the content provided by the user and answer with a JSON "
+    'object of the form {{"summary": "...", "tags": ["...", "..."]}}.\n'
+    '- "summary": one sentence retaining key information, in [language={language}]\n'
+    '- "tags": [at most] {max_tags} highly specific and meaningful tags for '
+    "archiving and categorizing the article. Focus on key technical concepts, "
+    "domains, and methodologies. Avoid generic or overly broad tags. "
+    "Lowercase, no spaces, in [language={language}]."
+)
+
+# Session-stable context that changes more often than the static preamble:
+# kept in a second system block so the truly static prefix still caches
+TAGS_CONTEXT_PROMPT = "Existing tags: {existing_tags}\n\nUser description: {personal_description}"
+
+TAGS_HINT_PROMPT = "Existing tags already found in the text (prefer reusing them): {candidates}"
+
+# Tags tolerate a looser semantic match than summaries
+TAGS_SEMANTIC_THRESHOLD = float(os.getenv("TAGS_SEMANTIC_THRESHOLD", "0.12"))
+
+# Constant request fragments hoisted so hot paths do not rebuild them
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+# Bounded fan-out for the batch helpers below
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 16))
+_llm_sem = asyncio.Semaphore(LLM_CONCURRENCY)
+
+async def _semantic_lookup(task: str, text: str, threshold=None):
+    """Embed text and look for a near-duplicate's stored response.
+    Returns (embedding, response-or-None); never raises."""
     try:
-        response = await chat_completion(
-            model=DEFAULT_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2,
-            max_tokens=200
-        )
-        return response.choices[0].message.content.strip()
+        embedding = await semantic_cache.embed(text)
+        return embedding, semantic_cache.lookup(task, embedding, threshold)
     except Exception as e:
-        raise OpenAIAPIError(f"Summarization failed: {str(e)}") from e
+        print(f"Semantic cache lookup failed: {str(e)}")
+        return None, None
 
-async def generate_tags(text: str, max_tags: int = 5, language: str = "zh-CN", max_content_length: int = 8192, existing_tags: List[str] = []) -> List[str]:
-    """Generate content tags with AI"""
-    prompt = f"""Please generate [at most] {max_tags} highly specific and meaningful tags for archiving and categorizing this article. Focus on key technical concepts, domains, and methodologies that would help with content organization and retrieval. Avoid generic or overly broad tags. Generate from the perspective of the user (comma-separated, lowercase, no spaces, in [{language=}]):
-    
-    {text[:max_content_length]}
-    
-    Example format: tag1,tag2,tag3
-    
-    Existing tags: {existing_tags}
-    
-    User description: {PERSONAL_DESCRIPTION}
-    """
-    
+def _semantic_store(task: str, embedding, response) -> None:
+    if embedding is None:
+        return
     try:
-        response = await chat_completion(
-            model=DEFAULT_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.5,
-            max_tokens=50
-        )
-        raw_tags = response.choices[0].message.content.lower()
-        return [tag.strip() for tag in raw_tags.split(',') if tag.strip()][:max_tags]
+        semantic_cache.store(task, embedding, response)
     except Exception as e:
-        raise OpenAIAPIError(f"Tag generation failed: {str(e)}") from e
+        print(f"Semantic cache store failed: {str(e)}")
+
+class OpenAIAPIError(Exception):
+    """Custom API exception"""
+    pass
+
+async def chat_completion(**kwargs) -> ChatCompletion:
+    """Unified chat completion interface; retries live in the SDK client"""
+    return await aclient.chat.completions.create(**kwargs)
+
+async def safe_chat_completion(**kwargs) -> ChatCompletion:
+    """chat_completion with exhausted retries re-raised as OpenAIAPIError"""
+    try:
+        return await chat_completion(**kwargs)
+    except (APIError, httpx.HTTPError, asyncio.TimeoutError) as e:
+        raise OpenAIAPIError(f"API request failed: {str(e)}") from e
+
+# Single-flight registry: concurrent calls with the same cache key share
+# one task, so a page submitted twice in the same batch hits the API once
+_inflight = {}
+
+async def _single_flight(key: str, run):
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(run())
+        _inflight[key] = task
+        task.add_done_callback(lambda _t: _inflight.pop(key, None))
+    return await task
+
+async def summarize_text(text: str, language: str = "zh-CN", max_content_length: int = 3000) -> str:
+    """Summarize text content with AI; max_content_length is in tokens"""
+    content = _truncate(text, max_content_length)
+    messages = [
+        {"role": "system", "content": SUMMARIZE_SYS_PROMPT.format(language=language)},
+        {"role": "user", "content": content}
+    ]
+
+    key = _messages_key(messages, 0.2, 200)
+
+    async def _run() -> str:
+        cached = _llm_cache.get(key)
+        if cached is not None:
+            return cached
+
+        task = f"summary:{language}"
+        embedding, hit = await _semantic_lookup(task, content)
+        if hit is not None:
+            return hit
+
+        try:
+            response = await safe_chat_completion(
+                model=DEFAULT_MODEL,
+                messages=messages,
+                temperature=0.2,
+                max_tokens=200
+            )
+            summary = response.choices[0].message.content.strip()
+        except Exception as e:
+            raise OpenAIAPIError(f"Summarization failed: {str(e)}") from e
+
+        _llm_cache.set(key, summary, expire=_LLM_CACHE_TTL)
+        _semantic_store(task, embedding, summary)
+        return summary
+
+    return await _single_flight(key, _run)
+
+async def generate_tags(text: str, max_tags: int = 5, language: str = "zh-CN", max_content_length: int = 3000, existing_tags: List[str] = []) -> List[str]:
+    """Generate content tags with AI; max_content_length is in tokens"""
+    # Canonical order: existing_tags often arrives as a set, and set
+    # iteration order changes across processes, which would change the
+    # prompt and defeat the persistent cache key across restarts
+    existing_tags = sorted(existing_tags)
+
+    # Cheap local fast path: existing tags that literally appear in the
+    # text are almost always right. If enough match, skip the embedding
+    # and LLM calls entirely; otherwise pass the matches on as hints
+    candidates = []
+    if existing_tags:
+        lowered = text.lower()
+        seen = set()
+        for tag in existing_tags:
+            t = tag.lower()
+            if t not in seen and t in lowered:
+                seen.add(t)
+                candidates.append(t)
+        if len(candidates) >= max_tags:
+            return candidates[:max_tags]
+
+    content = _truncate(text, max_content_length)
+    messages = [
+        {"role": "system", "content": TAGS_SYS_PROMPT.format(max_tags=max_tags, language=language)},
+        {"role": "system", "content": TAGS_CONTEXT_PROMPT.format(
+            existing_tags=existing_tags, personal_description=PERSONAL_DESCRIPTION)},
+    ]
+    if candidates:
+        messages.append({"role": "system", "content": TAGS_HINT_PROMPT.format(candidates=candidates)})
+    messages.append({"role": "user", "content": content})
+
+    key = _messages_key(messages, 0.5, 50)
+
+    async def _run() -> List[str]:
+        cached = _llm_cache.get(key)
+        if cached is not None:
+            return cached
+
+        task = f"tags:{language}"
+        embedding, hit = await _semantic_lookup(task, content,
+                                                threshold=TAGS_SEMANTIC_THRESHOLD)
+        if hit is not None:
+            return hit
+
+        try:
+            stream = await safe_chat_completion(
+                model=DEFAULT_MODEL,
+                messages=messages,
+                temperature=0.5,
+                max_tokens=50,
+                stream=True
+            )
+            # Stream the comma-separated output and abort the request as
+            # soon as max_tags tags are complete: the tail tokens are
+            # never generated, saving output tokens and latency
+            buf = ""
+            async with stream:
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        buf += delta
+                        if buf.count(',') >= max_tags:
+                            break
+            tags = [tag.strip() for tag in buf.lower().split(',') if tag.strip()][:max_tags]
+        except Exception as e:
+            raise OpenAIAPIError(f"Tag generation failed: {str(e)}") from e
+
+        _llm_cache.set(key, tags, expire=_LLM_CACHE_TTL)
+        _semantic_store(task, embedding, tags)
+        return tags
+
+    return await _single_flight(key, _run)
+
+async def summarize_and_tag(text: str, max_tags: int = 5, language: str = "zh-CN",
+                            max_content_length: int = 3000, existing_tags: List[str] = []) -> Tuple[str, List[str]]:
+    """Generate summary and tags in a single LLM call: the content is
+    transmitted once instead of twice, halving input tokens and latency.
+    max_content_length is in tokens"""
+    # Canonical order so the prompt (and persistent cache key) does not
+    # depend on set iteration order
+    existing_tags = sorted(existing_tags)
+    content = _truncate(text, max_content_length)
+    messages = [
+        {"role": "system", "content": SUMMARIZE_AND_TAG_SYS_PROMPT.format(
+            max_tags=max_tags, language=language)},
+        {"role": "system", "content": TAGS_CONTEXT_PROMPT.format(
+            existing_tags=existing_tags, personal_description=PERSONAL_DESCRIPTION)},
+        {"role": "user", "content": content}
+    ]
+
+    key = _messages_key(messages, 0.3, 250)
+
+    async def _run() -> Tuple[str, List[str]]:
+        cached = _llm_cache.get(key)
+        if cached is not None:
+            return cached
+
+        task = f"summary+tags:{language}"
+        embedding, hit = await _semantic_lookup(task, content)
+        if hit is not None:
+            return hit
+
+        try:
+            response = await safe_chat_completion(
+                model=DEFAULT_MODEL,
+                messages=messages,
+                temperature=0.3,
+                max_tokens=250,
+                response_format=_JSON_RESPONSE_FORMAT
+            )
+            data = json.loads(response.choices[0].message.content)
+            summary = str(data.get("summary", "")).strip()
+            raw_tags = data.get("tags", [])
+            tags = [str(tag).strip().lower() for tag in raw_tags if str(tag).strip()][:max_tags]
+        except Exception as e:
+            raise OpenAIAPIError(f"Summarize+tag failed: {str(e)}") from e
+
+        _llm_cache.set(key, (summary, tags), expire=_LLM_CACHE_TTL)
+        _semantic_store(task, embedding, (summary, tags))
+        return summary, tags
+
+    return await _single_flight(key, _run)
+
+async def summarize_texts(texts: List[str], language: str = "zh-CN",
+                          max_content_length: int = 3000) -> List:
+    """Summarize many texts concurrently under LLM_CONCURRENCY; failures
+    come back as exceptions in the result list instead of aborting the batch"""
+    async def _one(text: str):
+        async with _llm_sem:
+            return await summarize_text(text, language=language,
+                                        max_content_length=max_content_length)
+    return await asyncio.gather(*(_one(t) for t in texts), return_exceptions=True)
+
+async def generate_tags_batch(texts: List[str], max_tags: int = 5, language: str = "zh-CN",
+                              max_content_length: int = 3000, existing_tags: List[str] = []) -> List:
+    """Generate tags for many texts concurrently under LLM_CONCURRENCY"""
+    async def _one(text: str):
+        async with _llm_sem:
+            return await generate_tags(text, max_tags=max_tags, language=language,
+                                       max_content_length=max_content_length,
+                                       existing_tags=existing_tags)
+    return await asyncio.gather(*(_one(t) for t in texts), return_exceptions=True)
 
 if __name__ == "__main__":
-    import asyncio
-    
+
     async def test_apis():
         test_text = """Natural language processing is an important field of artificial intelligence, 
         mainly studying theories and methods for effective communication between humans and machines 
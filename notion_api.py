@@ -1,8 +1,13 @@
+import asyncio
 import os
+from collections import deque
+
 import dotenv
 import httpx
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-from typing import Dict, List, Optional
+import orjson
+from aiolimiter import AsyncLimiter
+from async_lru import alru_cache
+from typing import AsyncIterator, Dict, List, Optional
 
 import rich
 
@@ -15,99 +20,118 @@ NOTION_DATABASE_ID = os.getenv("NOTION_DATABASE_ID")
 NOTION_AUTH_HEADER = f"Bearer {NOTION_API_KEY}"
 NOTION_VERSION = "2022-06-28"
 
+# C加速的JSON编解码:递归抓取要解码上百个payload,stdlib json会占满事件循环;
+# 编码同理(httpx的json=走stdlib dumps),且orjson原生支持datetime/UUID
+_loads = orjson.loads
+_dumps = orjson.dumps
+
+# 预序列化body时需要自带的Content-Type;模块级常量,避免每次调用重建dict
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# 共享异步客户端:连接池复用keep-alive连接,避免每个请求重新TLS握手;
+# HTTP/2让并发请求在同一条TCP+TLS连接上多路复用
+def _make_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url="https://api.notion.com/v1",
+        http2=True,
+        headers={
+            "Authorization": NOTION_AUTH_HEADER,
+            "Notion-Version": NOTION_VERSION,
+            # 显式请求压缩:深层block树动辄上百KB的JSON,gzip/br可省~4-5×带宽
+            "Accept-Encoding": "gzip, br"
+        },
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        timeout=httpx.Timeout(30.0, connect=10.0)
+    )
+
+_client = _make_client()
+
+# 生命周期钩子:绑定到宿主框架(如FastAPI lifespan)的startup/shutdown,
+# 保证keep-alive连接池贯穿整个进程生命周期,退出时优雅释放套接字
+async def startup():
+    """若共享客户端已被关闭则重建;可安全地重复调用"""
+    global _client
+    if _client.is_closed:
+        _client = _make_client()
+
+async def shutdown():
+    """关闭共享客户端,优雅释放连接;长驻进程退出前调用"""
+    await _client.aclose()
+
+async def aclose():
+    """shutdown的旧名,保留兼容"""
+    await shutdown()
+
+# 限制并发请求数,与连接池大小一致
+_block_sem = asyncio.Semaphore(32)
+
+# 令牌桶限速:Notion API上限为3 req/s,留一点余量自行控速,避免撞429后再退避
+_limiter = AsyncLimiter(max_rate=2.5, time_period=1.0)
+
+async def _request(method: str, url: str, **kwargs) -> httpx.Response:
+    """限速发送请求,内联重试:成功路径零额外开销
+    - 429: 按Retry-After等待后重发
+    - 408/409/5xx: 指数退避后重试,最多5次;其余4xx不重试
+    """
+    for attempt in range(5):
+        async with _limiter:
+            response = await _client.request(method, url, **kwargs)
+        status = response.status_code
+        if status == 429:
+            await asyncio.sleep(float(response.headers.get("Retry-After", 2 ** attempt)))
+            continue
+        if (status in (408, 409) or status >= 500) and attempt < 4:
+            await asyncio.sleep(min(2 ** attempt, 30))
+            continue
+        break
+    return response
+
 class NotionAPIError(Exception):
     """Notion API自定义异常"""
     pass
 
-# 异步重试装饰器
-notion_retry = retry(
-    stop=stop_after_attempt(5),
-    wait=wait_exponential(multiplier=1, min=2, max=30),
-    retry=retry_if_exception_type(httpx.HTTPStatusError),
-    reraise=True
-)
-
-@notion_retry
-async def query_database(filter: Optional[Dict] = None, sorts: Optional[List] = None) -> Dict:
-    """异步查询数据库"""
-    url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-    payload = {}
-    if filter: payload["filter"] = filter
-    if sorts: payload["sorts"] = sorts
-
-    headers = {
-        "Authorization": NOTION_AUTH_HEADER,
-        "Notion-Version": NOTION_VERSION,
-        "Content-Type": "application/json"
-    }
-
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            url,
-            headers=headers,
-            json=payload
-        )
-    
-    if response.status_code != 200:
-        raise NotionAPIError(f"查询失败[{response.status_code}]: {response.text}")
-    
-    return response.json()
-
-@notion_retry
+@alru_cache(maxsize=4096, ttl=300)
 async def async_get_block_children(block_id: str, recursive: bool = False) -> Dict:
     """异步获取block子内容"""
-    url = f"https://api.notion.com/v1/blocks/{block_id}/children"
+    url = f"/blocks/{block_id}/children"
     params = {"page_size": 100}
-    
-    headers = {
-        "Authorization": NOTION_AUTH_HEADER,
-        "Notion-Version": NOTION_VERSION
-    }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            url,
-            headers=headers,
-            params=params
-        )
-    
+    async with _block_sem:
+        response = await _request("GET", url, params=params)
+
     if response.status_code != 200:
         raise NotionAPIError(f"获取block失败[{response.status_code}]: {response.text}")
-    
-    data = response.json()
-    
-    # 递归获取子block
+
+    data = _loads(response.content)
+
+    # 递归获取子block;deque累积避免长翻页时list反复扩容,最后一次性转list
     if recursive and data.get("has_more"):
+        results = deque(data["results"])
         next_cursor = data.get("next_cursor")
         while next_cursor:
             params["start_cursor"] = next_cursor
-            next_response = await client.get(url, headers={
-                "Authorization": NOTION_AUTH_HEADER,
-                "Notion-Version": NOTION_VERSION
-            }, params=params)
-            next_data = next_response.json()
-            data["results"].extend(next_data.get("results", []))
+            async with _block_sem:
+                next_response = await _request("GET", url, params=params)
+            next_data = _loads(next_response.content)
+            results.extend(next_data.get("results", []))
             next_cursor = next_data.get("next_cursor")
-    
+        data["results"] = list(results)
+        data["has_more"] = False
+        data["next_cursor"] = None
+
     return data
 
-@notion_retry
 async def get_database() -> Dict:
     """异步获取数据库信息"""
-    url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}"
-    headers = {
-        "Authorization": NOTION_AUTH_HEADER,
-        "Notion-Version": NOTION_VERSION
-    }
+    url = f"/databases/{NOTION_DATABASE_ID}"
+
+    response = await _request("GET", url)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
-    
     response.raise_for_status()
-    return response.json()
+    return _loads(response.content)
 
-@notion_retry
-async def query_database(filter=None, sorts=None):
+async def query_database(filter=None, sorts=None, start_cursor=None, page_size=100,
+                         raw_body: Optional[bytes] = None, get_all: bool = False):
     """
     Example Usage:
     ```
@@ -121,29 +145,47 @@ async def query_database(filter=None, sorts=None):
             sorts=[{"property": "Last ordered", "direction": "ascending"}]
         )
     ```
+    get_all=True follows has_more/next_cursor and returns every matching
+    row in one response; callers that stream page by page (cursor-based)
+    should keep the default and manage the cursor themselves.
     """
 
-    url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-    headers = {
-        "Authorization": NOTION_AUTH_HEADER,
-        "Notion-Version": NOTION_VERSION,
-        "Content-Type": "application/json"
-    }
-    
-    payload = {}
+    url = f"/databases/{NOTION_DATABASE_ID}/query"
+
+    if raw_body is not None:
+        # 调用方预序列化好的固定payload:跳过每次轮询的dict构造和JSON序列化
+        response = await _request("POST", url, content=raw_body,
+                                  headers=_JSON_HEADERS)
+        response.raise_for_status()
+        return _loads(response.content)
+
+    payload = {"page_size": min(page_size, 100)}  # API maximum is 100
     if filter:
         payload["filter"] = filter
     if sorts:
         payload["sorts"] = sorts
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=payload)
+    if start_cursor:
+        payload["start_cursor"] = start_cursor
+
+    response = await _request("POST", url, content=_dumps(payload), headers=_JSON_HEADERS)
 
     response.raise_for_status()
 
-    return response.json()
+    data = _loads(response.content)
+
+    # 翻页直到has_more=False,共享客户端上复用同一条连接
+    if get_all and data.get("has_more"):
+        results = deque(data["results"])
+        while data.get("has_more"):
+            payload["start_cursor"] = data["next_cursor"]
+            response = await _request("POST", url, content=_dumps(payload), headers=_JSON_HEADERS)
+            response.raise_for_status()
+            data = _loads(response.content)
+            results.extend(data.get("results", []))
+        data["results"] = list(results)
+
+    return data
 
-@notion_retry
 async def get_page(page_id: str):
     """
     Example Usage:
@@ -151,19 +193,79 @@ async def get_page(page_id: str):
         page = get_page("b55c9c91-384d-452b-81db-d1ef79372b75")
     ```
     """
-    url = f"https://api.notion.com/v1/pages/{page_id}"
-    headers = {
-        "Authorization": NOTION_AUTH_HEADER,
-        "Notion-Version": NOTION_VERSION
-    }
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
+    url = f"/pages/{page_id}"
+
+    response = await _request("GET", url)
     response.raise_for_status()
-    return response.json()
+    return _loads(response.content)
+
+# 单飞注册表:并发遍历时两个父节点可能同时请求同一block的同一页,
+# 后到的调用者复用在途任务而不是再发一次HTTP请求
+_inflight: Dict[str, "asyncio.Task"] = {}
+
+async def _get_children_page(url: str, params: Dict) -> Dict:
+    """抓取单页子block;相同请求在途时等待同一个任务"""
+    key = f"{url}#{params.get('page_size')}#{params.get('start_cursor')}"
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_children_page(url, params))
+        _inflight[key] = task
+        task.add_done_callback(lambda _t: _inflight.pop(key, None))
+    return await task
+
+async def _fetch_children_page(url: str, params: Dict) -> Dict:
+    async with _block_sem:
+        response = await _request("GET", url, params=params)
+    response.raise_for_status()
+    return _loads(response.content)
+
+async def iter_block_children(block_id: str, size: int = 100, start_cursor: str = None,
+                              get_all: bool = False, recursive: bool = False) -> AsyncIterator[Dict]:
+    """
+    逐块产出子block:每拿到一页就开始产出,调用方无需等整棵树抓完
+    Example Usage:
+    ```
+        async for block in iter_block_children("b55c9c91-...", get_all=True):
+            ...
+    ```
+    """
+    url = f"/blocks/{block_id}/children"
+    page_size = min(size, 100)  # API maximum is 100
+
+    # 首页不带start_cursor键:httpx会把None序列化成空字符串参数
+    params = {'page_size': page_size}
+    if start_cursor:
+        params['start_cursor'] = start_cursor
+    data = await _get_children_page(url, params)
+
+    while True:
+        # Probe the next page right away so it downloads while we are
+        # still fetching this page's nested children
+        next_task = None
+        if data.get('has_more', False) and get_all:
+            next_task = asyncio.create_task(_get_children_page(url, {
+                'page_size': page_size,
+                'start_cursor': data.get('next_cursor')
+            }))
 
-@notion_retry
-async def get_block_children(block_id: str, size: int = 100, start_cursor: str = None, 
+        # Fetch nested children concurrently: sibling subtrees fan out
+        # instead of being awaited one at a time
+        if recursive:
+            child_blocks = [b for b in data.get('results', []) if b.get('has_children')]
+            if child_blocks:
+                await asyncio.gather(*(
+                    _fetch_child_blocks(block, size) for block in child_blocks
+                ))
+
+        for block in data.get('results', []):
+            yield block
+
+        if next_task is None:
+            break
+        data = await next_task
+
+@alru_cache(maxsize=4096, ttl=300)
+async def get_block_children(block_id: str, size: int = 100, start_cursor: str = None,
                       get_all: bool = False, recursive: bool = False):
     """
     Example Usage:
@@ -172,58 +274,40 @@ async def get_block_children(block_id: str, size: int = 100, start_cursor: str =
         all_blocks = get_block_children("b55c9c91-...", get_all=True, recursive=True)
     ```
     """
-    url = f"https://api.notion.com/v1/blocks/{block_id}/children"
-    headers = {
-        "Authorization": NOTION_AUTH_HEADER,
-        "Notion-Version": NOTION_VERSION
-    }
-    
-    all_results = []
-    has_more = True
-    next_cursor = start_cursor
-
-    while has_more:
-        params = {
-            'page_size': min(size, 100),  # API maximum is 100
-            'start_cursor': next_cursor
-        }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        
-        # Process blocks and fetch nested children if needed
-        for block in data.get('results', []):
-            if recursive and block.get('has_children'):
-                try:
-                    block['children'] = await get_block_children(
-                        block['id'],
-                        size=size,
-                        get_all=True,
-                        recursive=True
-                    )
-                except Exception as e:
-                    print(f"Error fetching children for block {block['id']}: {str(e)}")
-        
-        all_results.extend(data.get('results', []))
-        has_more = data.get('has_more', False) and get_all
-        next_cursor = data.get('next_cursor')
-
-        if not get_all:
-            break
+    all_results = [block async for block in iter_block_children(
+        block_id, size=size, start_cursor=start_cursor,
+        get_all=get_all, recursive=recursive
+    )]
 
     # Maintain original API response structure
     return {
         'object': 'list',
         'results': all_results,
-        'has_more': has_more,
-        'next_cursor': next_cursor,
-        'type': data.get('type', 'block'),
-        'block': data.get('block', {})
+        'has_more': False,
+        'next_cursor': None,
+        'type': 'block',
+        'block': {}
     }
 
-@notion_retry
+def clear_block_cache():
+    """清空block缓存;每轮轮询开始时调用,保证拿到最新内容"""
+    async_get_block_children.cache_clear()
+    get_block_children.cache_clear()
+
+async def _fetch_child_blocks(block: Dict, size: int):
+    """递归拉取单个block的子树,失败时不中断兄弟节点"""
+    try:
+        children = await get_block_children(
+            block['id'],
+            size=size,
+            get_all=True,
+            recursive=True
+        )
+        block['children'] = children.get('results', [])
+    except Exception as e:
+        print(f"Error fetching children for block {block['id']}: {str(e)}")
+
+
 async def update_page(
     page_id: str,
     properties: Dict,
@@ -244,13 +328,8 @@ async def update_page(
         )
     ```
     """
-    url = f"https://api.notion.com/v1/pages/{page_id}"
-    headers = {
-        "Authorization": NOTION_AUTH_HEADER,
-        "Notion-Version": NOTION_VERSION,
-        "Content-Type": "application/json"
-    }
-    
+    url = f"/pages/{page_id}"
+
     payload = {
         "properties": properties,
         "in_trash": in_trash
@@ -258,13 +337,12 @@ async def update_page(
     if icon: payload["icon"] = icon
     if cover: payload["cover"] = cover
 
-    async with httpx.AsyncClient() as client:
-        response = await client.patch(url, headers=headers, json=payload)
-    
+    response = await _request("PATCH", url, content=_dumps(payload), headers=_JSON_HEADERS)
+
     if response.status_code != 200:
         raise NotionAPIError(f"Update failed[{response.status_code}]: {response.text}")
     
-    return response.json()
+    return _loads(response.content)
 
 if __name__ =='__main__':
     import asyncio
@@ -0,0 +1,79 @@
+import os
+import dotenv
+import diskcache
+import hnswlib
+from openai import AsyncOpenAI
+from typing import List, Optional
+
+dotenv.load_dotenv()
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Cosine distance below which two inputs count as "the same document";
+# callers may pass a looser threshold per task
+DEFAULT_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.08"))
+
+_DIM = 1536
+_MAX_ELEMENTS = 100_000
+_CACHE_DIR = './.semantic_cache'
+_INDEX_PATH = os.path.join(_CACHE_DIR, 'index.bin')
+
+def _make_client() -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+
+aclient = _make_client()
+
+# label -> (task, response), persisted next to the vector index
+_store = diskcache.Cache(os.path.join(_CACHE_DIR, 'responses'))
+
+_index = hnswlib.Index(space='cosine', dim=_DIM)
+if os.path.exists(_INDEX_PATH):
+    _index.load_index(_INDEX_PATH, max_elements=_MAX_ELEMENTS)
+else:
+    os.makedirs(_CACHE_DIR, exist_ok=True)
+    _index.init_index(max_elements=_MAX_ELEMENTS, ef_construction=200, M=16)
+_index.set_ef(64)
+
+async def startup():
+    """Recreate the embedding client if it was closed; called from
+    llm_api.startup(), safe to call twice"""
+    global aclient
+    if aclient.is_closed():
+        aclient = _make_client()
+
+async def aclose():
+    """Close the embedding client; called from llm_api.shutdown()"""
+    await aclient.close()
+
+async def embed(text: str) -> List[float]:
+    """Embed text for cache lookup/storage"""
+    response = await aclient.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return response.data[0].embedding
+
+def lookup(task: str, embedding: List[float], threshold: Optional[float] = None):
+    """
+    Return the stored response for the nearest neighbor of `embedding`
+    within `threshold` cosine distance and the same `task`, or None.
+    """
+    threshold = DEFAULT_THRESHOLD if threshold is None else threshold
+    count = _index.get_current_count()
+    if count == 0:
+        return None
+
+    labels, distances = _index.knn_query([embedding], k=min(3, count))
+    for label, distance in zip(labels[0], distances[0]):
+        if distance > threshold:
+            break  # results are sorted by distance
+        entry = _store.get(int(label))
+        if entry is not None and entry[0] == task:
+            return entry[1]
+    return None
+
+def store(task: str, embedding: List[float], response) -> None:
+    """Persist a freshly generated response under its embedding"""
+    label = _store.incr('_next_label')
+    _store.set(label, (task, response))
+    _index.add_items([embedding], [label])
+    _index.save_index(_INDEX_PATH)